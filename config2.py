@@ -4,6 +4,7 @@ config2.py
 """
 
 from dataclasses import dataclass, field
+from typing import Optional
 import torch
 
 
@@ -20,6 +21,9 @@ class ModelConfig:
     bnb_4bit_compute_dtype: torch.dtype = torch.bfloat16
     device_map: dict = field(default_factory=lambda: {"": 0})
     trust_remote_code: bool = True
+    # torch.compile 模式（如 "reduce-overhead"），None 為不編譯
+    # 4bit 量化層與動態 KV cache 可能無法編譯，失敗時自動退回 eager
+    compile_mode: Optional[str] = None
 
 
 # =========================================================
@@ -32,6 +36,11 @@ class GenerationConfig:
     temperature: float = 0.7
     top_p: float = 0.8
     repetition_penalty: float = 1.2
+    reuse_prefix_cache: bool = True         # 重用靜態 system prompt 的 KV cache
+    # 量化 KV cache（降低 decode 時的記憶體頻寬）；None 為不量化
+    # 需安裝 optimum-quanto 或 hqq，且啟用時不重用前綴 KV cache
+    kv_cache_nbits: Optional[int] = None    # 可選 2 或 4
+    kv_cache_backend: str = "quanto"        # 可選 "quanto" 或 "HQQ"
 
     def to_generate_kwargs(self, pad_token_id: int, eos_token_id: int) -> dict:
         return {
@@ -43,6 +52,15 @@ class GenerationConfig:
             "eos_token_id": eos_token_id,
         }
 
+    def to_cache_kwargs(self) -> dict:
+        """KV cache 相關的 generate 參數"""
+        if self.kv_cache_nbits is None:
+            return {}
+        return {
+            "cache_implementation": "quantized",
+            "cache_config": {"nbits": self.kv_cache_nbits, "backend": self.kv_cache_backend},
+        }
+
 
 # =========================================================
 # 💬 Prompt 設定
@@ -62,7 +80,7 @@ class PromptConfig:
 class MemoryConfig:
     """記憶系統設定"""
     use_summary_memory: bool = True         # ✅ 啟用記憶系統
-    max_token_limit: int = 2000
+    summary_max_new_tokens: int = 100       # 結案摘要的最大生成長度
 
     # Docker PostgreSQL 設定
     db_host: str = "localhost"
@@ -70,6 +88,10 @@ class MemoryConfig:
     db_name: str = "main"
     db_user: str = "postgres"
     db_password: str = "mypassword"
+    db_connect_timeout: int = 3              # 連線逾時秒數（資料庫無回應時快速退回停用模式）
+    db_prepare_threshold: Optional[int] = 0  # 執行幾次後轉為 prepared statement（0 為第一次執行即準備，None 為停用）
+    db_pool_min_size: int = 1                # 連線池最小連線數
+    db_pool_max_size: int = 3                # 連線池最大連線數（單一 Streamlit 程序已足夠）
 
     auto_save_on_closure: bool = True
     compression_strategy: str = "summary"   # 可選 "summary" 或 "buffer"
@@ -2,16 +2,43 @@
 資料庫管理 - PostgreSQL 操作
 """
 
-import psycopg2
-from psycopg2 import pool, extras
-from typing import Optional, Dict, List
-from datetime import datetime
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import args_row
+from psycopg_pool import ConnectionPool
+from collections import namedtuple
+from typing import Optional, List, Iterable, Tuple
+from datetime import datetime, timezone
 import logging
 
 from config import MemoryConfig
 
 logger = logging.getLogger(__name__)
 
+# session_summary 查詢結果列（tuple 存取，避免每列建立 dict）
+SessionRow = namedtuple("SessionRow", [
+    "id", "user_id", "session_id", "summary_text", "stage_completed",
+    "emotion_trend", "belief_change", "total_turns", "created_at", "updated_at"
+])
+_SESSION_COLUMNS = ", ".join(SessionRow._fields)
+
+# session_summary 的 upsert 語句（單筆與批次儲存共用）
+# updated_at 由用戶端提供，讓同一批次的資料共用一致的時間戳
+UPSERT_SESSION_SQL = """
+    INSERT INTO session_summary 
+    (user_id, session_id, summary_text, stage_completed, 
+     emotion_trend, belief_change, total_turns, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (session_id) 
+    DO UPDATE SET
+        summary_text = EXCLUDED.summary_text,
+        stage_completed = EXCLUDED.stage_completed,
+        emotion_trend = EXCLUDED.emotion_trend,
+        belief_change = EXCLUDED.belief_change,
+        total_turns = EXCLUDED.total_turns,
+        updated_at = EXCLUDED.updated_at;
+"""
+
 
 class DatabaseManager:
     """PostgreSQL 資料庫管理器"""
@@ -24,83 +51,80 @@ class DatabaseManager:
             config: 記憶系統配置
         """
         self.config = config
-        self.connection_pool = None
+        self.pool = None
         self._init_connection_pool()
+        # 連線池不可用時，所有公開方法直接返回，不再嘗試取得連線
+        self.enabled = self.pool is not None
     
     def _init_connection_pool(self):
-        """初始化連線池"""
+        """初始化連線池（psycopg3，伺服器端參數綁定與自動 prepared statement）"""
         try:
-            self.connection_pool = psycopg2.pool.SimpleConnectionPool(
-                1,  # 最小連線數
-                10,  # 最大連線數
+            conninfo = make_conninfo(
                 host=self.config.db_host,
                 port=self.config.db_port,
-                database=self.config.db_name,
+                dbname=self.config.db_name,
                 user=self.config.db_user,
-                password=self.config.db_password
+                password=self.config.db_password,
+                connect_timeout=self.config.db_connect_timeout
             )
+            self.pool = ConnectionPool(
+                conninfo=conninfo,
+                min_size=self.config.db_pool_min_size,
+                max_size=self.config.db_pool_max_size,
+                # 同一 SQL 執行次數超過門檻後轉為伺服器端 prepared statement，省去重複 parse/plan
+                kwargs={"prepare_threshold": self.config.db_prepare_threshold},
+                open=True
+            )
+            # 等待最小連線建立，逾時（資料庫無法連線）時在此拋出錯誤
+            self.pool.wait(timeout=self.config.db_connect_timeout)
             logger.info("✅ 資料庫連線池初始化成功")
-        except psycopg2.Error as e:
+        except psycopg.Error as e:
             logger.error(f"❌ 資料庫連線失敗: {e}")
-            self.connection_pool = None
-    
-    def get_connection(self):
-        """從連線池獲取連線"""
-        if self.connection_pool:
-            return self.connection_pool.getconn()
-        return None
-    
-    def return_connection(self, conn):
-        """歸還連線到連線池"""
-        if self.connection_pool and conn:
-            self.connection_pool.putconn(conn)
+            if self.pool is not None:
+                self.pool.close()
+            self.pool = None
     
     def create_tables(self):
         """創建必要的資料表"""
-        conn = self.get_connection()
-        if not conn:
+        if not self.enabled:
             logger.error("❌ 無法獲取資料庫連線")
             return False
         
         try:
-            cursor = conn.cursor()
-            
-            # 創建 session_summary 資料表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS session_summary (
-                    id SERIAL PRIMARY KEY,
-                    user_id VARCHAR(36) NOT NULL,
-                    session_id VARCHAR(36) UNIQUE NOT NULL,
-                    summary_text TEXT NOT NULL,
-                    stage_completed VARCHAR(50),
-                    emotion_trend TEXT,
-                    belief_change TEXT,
-                    total_turns INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    updated_at TIMESTAMP DEFAULT NOW()
-                );
-            """)
-            
-            # 創建索引
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_user_id ON session_summary(user_id);
-            """)
-            
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_created_at ON session_summary(created_at DESC);
-            """)
+            with self.pool.connection() as conn:
+                # 創建 session_summary 資料表
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS session_summary (
+                        id SERIAL PRIMARY KEY,
+                        user_id VARCHAR(36) NOT NULL,
+                        session_id VARCHAR(36) UNIQUE NOT NULL,
+                        summary_text TEXT NOT NULL,
+                        stage_completed VARCHAR(50),
+                        emotion_trend TEXT,
+                        belief_change TEXT,
+                        total_turns INTEGER DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT NOW(),
+                        updated_at TIMESTAMP DEFAULT NOW()
+                    );
+                """)
+                
+                # 創建索引：get_user_sessions 依 user_id 篩選並依 created_at 排序，
+                # 複合索引可直接做索引範圍掃描，不需額外排序
+                conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_user_created
+                    ON session_summary(user_id, created_at DESC);
+                """)
+                
+                # 移除被複合索引取代的舊索引，減少寫入時的索引維護
+                conn.execute("DROP INDEX IF EXISTS idx_user_id;")
+                conn.execute("DROP INDEX IF EXISTS idx_created_at;")
             
-            conn.commit()
-            cursor.close()
             logger.info("✅ 資料表創建成功")
             return True
             
-        except psycopg2.Error as e:
+        except psycopg.Error as e:
             logger.error(f"❌ 資料表創建失敗: {e}")
-            conn.rollback()
             return False
-        finally:
-            self.return_connection(conn)
     
     def save_session_summary(
         self,
@@ -127,78 +151,89 @@ class DatabaseManager:
         Returns:
             是否儲存成功
         """
-        conn = self.get_connection()
-        if not conn:
+        if not self.enabled:
             logger.error("❌ 無法獲取資料庫連線")
             return False
         
         try:
-            cursor = conn.cursor()
+            with self.pool.connection() as conn:
+                conn.execute(UPSERT_SESSION_SQL, (
+                    user_id, session_id, summary_text, stage_completed,
+                    emotion_trend, belief_change, total_turns, datetime.now(timezone.utc)
+                ))
             
-            cursor.execute("""
-                INSERT INTO session_summary 
-                (user_id, session_id, summary_text, stage_completed, 
-                 emotion_trend, belief_change, total_turns, updated_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
-                ON CONFLICT (session_id) 
-                DO UPDATE SET
-                    summary_text = EXCLUDED.summary_text,
-                    stage_completed = EXCLUDED.stage_completed,
-                    emotion_trend = EXCLUDED.emotion_trend,
-                    belief_change = EXCLUDED.belief_change,
-                    total_turns = EXCLUDED.total_turns,
-                    updated_at = NOW();
-            """, (user_id, session_id, summary_text, stage_completed, 
-                  emotion_trend, belief_change, total_turns))
-            
-            conn.commit()
-            cursor.close()
             logger.info(f"✅ Session 摘要已儲存: {session_id}")
             return True
             
-        except psycopg2.Error as e:
+        except psycopg.Error as e:
             logger.error(f"❌ 儲存 Session 摘要失敗: {e}")
-            conn.rollback()
             return False
-        finally:
-            self.return_connection(conn)
     
-    def get_session_summary(self, session_id: str) -> Optional[Dict]:
+    def save_session_summaries_bulk(self, rows: Iterable[Tuple]) -> bool:
         """
-        獲取 session 摘要
+        批次儲存多筆 session 摘要
+        
+        以 pipeline 模式送出所有 upsert，只需一次同步往返，
+        取代逐筆呼叫 save_session_summary 的 N 次往返；
+        同一批次的 updated_at 使用相同時間戳。
         
         Args:
-            session_id: Session ID
+            rows: (user_id, session_id, summary_text, stage_completed,
+                   emotion_trend, belief_change, total_turns) 的序列
             
         Returns:
-            摘要資料字典
+            是否儲存成功
         """
-        conn = self.get_connection()
-        if not conn:
-            return None
+        if not self.enabled:
+            logger.error("❌ 無法獲取資料庫連線")
+            return False
+        
+        updated_at = datetime.now(timezone.utc)
+        rows = [(*row, updated_at) for row in rows]
+        if not rows:
+            return True
         
         try:
-            cursor = conn.cursor(cursor_factory=extras.RealDictCursor)
+            with self.pool.connection() as conn:
+                with conn.pipeline():
+                    with conn.cursor() as cursor:
+                        cursor.executemany(UPSERT_SESSION_SQL, rows)
             
-            cursor.execute("""
-                SELECT * FROM session_summary
-                WHERE session_id = %s
-            """, (session_id,))
+            logger.info(f"✅ 已批次儲存 {len(rows)} 筆 Session 摘要")
+            return True
             
-            result = cursor.fetchone()
-            cursor.close()
+        except psycopg.Error as e:
+            logger.error(f"❌ 批次儲存 Session 摘要失敗: {e}")
+            return False
+    
+    def get_session_summary(self, session_id: str) -> Optional[SessionRow]:
+        """
+        獲取 session 摘要
+        
+        Args:
+            session_id: Session ID
             
-            if result:
-                return dict(result)
+        Returns:
+            摘要資料（SessionRow，需要字典時可呼叫 _asdict()）
+        """
+        if not self.enabled:
             return None
+        
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor(row_factory=args_row(SessionRow)) as cursor:
+                    cursor.execute(f"""
+                        SELECT {_SESSION_COLUMNS} FROM session_summary
+                        WHERE session_id = %s
+                    """, (session_id,))
+                    
+                    return cursor.fetchone()
             
-        except psycopg2.Error as e:
+        except psycopg.Error as e:
             logger.error(f"❌ 獲取 Session 摘要失敗: {e}")
             return None
-        finally:
-            self.return_connection(conn)
     
-    def get_user_sessions(self, user_id: str, limit: int = 10) -> List[Dict]:
+    def get_user_sessions(self, user_id: str, limit: int = 10) -> List[SessionRow]:
         """
         獲取使用者的歷史 sessions
         
@@ -207,37 +242,32 @@ class DatabaseManager:
             limit: 限制數量
             
         Returns:
-            session 列表
+            session 列表（SessionRow）
         """
-        conn = self.get_connection()
-        if not conn:
+        if not self.enabled:
             return []
         
         try:
-            cursor = conn.cursor(cursor_factory=extras.RealDictCursor)
-            
-            cursor.execute("""
-                SELECT * FROM session_summary
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-                LIMIT %s
-            """, (user_id, limit))
-            
-            results = cursor.fetchall()
-            cursor.close()
-            
-            return [dict(row) for row in results]
+            with self.pool.connection() as conn:
+                with conn.cursor(row_factory=args_row(SessionRow)) as cursor:
+                    cursor.execute(f"""
+                        SELECT {_SESSION_COLUMNS} FROM session_summary
+                        WHERE user_id = %s
+                        ORDER BY created_at DESC
+                        LIMIT %s
+                    """, (user_id, limit))
+                    
+                    return cursor.fetchall()
             
-        except psycopg2.Error as e:
+        except psycopg.Error as e:
             logger.error(f"❌ 獲取使用者 Sessions 失敗: {e}")
             return []
-        finally:
-            self.return_connection(conn)
     
     def close(self):
         """關閉連線池"""
-        if self.connection_pool:
-            self.connection_pool.closeall()
+        if self.enabled:
+            self.enabled = False
+            self.pool.close()
             logger.info("✅ 資料庫連線池已關閉")
 
 
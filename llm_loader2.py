@@ -4,13 +4,25 @@ llm_loader2.py
 刪除 UI 與日誌相關程式
 """
 
+import copy
+import re
+from threading import Lock, Thread
+from typing import Dict, Optional, Tuple
+
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, TextIteratorStreamer
+)
+from transformers.cache_utils import DynamicCache
 from config2 import AppConfig
-from prompt_templates2_pro import create_formatter
+from prompt_templates2_pro import STAGE_RULES, create_formatter
 from memory_manager import MemoryManager  # ✅ 使用原始的 DB 記憶架構
 
 
+# 一次掃描擷取回覆中的所有分析欄位：【key】value（到行尾）
+_ANALYSIS_RE = re.compile(r"【(emotion|context|belief|stage)】([^\n]*)")
+
+
 # =========================================================
 # 🧠 模型載入器
 # =========================================================
@@ -38,8 +50,24 @@ class ModelLoader:
             trust_remote_code=self.config.model.trust_remote_code,
             device_map=self.config.model.device_map
         )
+        if self.config.model.compile_mode:
+            self._compile(model, tokenizer)
         return model, tokenizer
 
+    def _compile(self, model, tokenizer):
+        """以 torch.compile 融合 decode 階段的小 kernel，並先暖機觸發編譯"""
+        eager_forward = model.forward
+        model.forward = torch.compile(
+            model.forward, mode=self.config.model.compile_mode, fullgraph=False
+        )
+        try:
+            warmup = tokenizer(["你好"], return_tensors="pt").to(model.device)
+            with torch.inference_mode():
+                model.generate(**warmup, max_new_tokens=4)
+        except Exception as e:
+            print(f"[Compile Warning] torch.compile 失敗，改用 eager 模式: {str(e)}")
+            model.forward = eager_forward
+
 
 # =========================================================
 # 🤖 Qwen 對話代理（主核心）
@@ -51,65 +79,181 @@ class QwenAgent:
         self.tokenizer = tokenizer
         self.config = config
         self.prompt_formatter = create_formatter()
-        self.memory = MemoryManager(model, tokenizer, config.memory)  # ✅ 使用真實 PostgreSQL 記憶管理器
+        # 模型同一時間只跑一個前向/生成（回覆、前綴 prefill 與結案摘要共用）
+        self._model_lock = Lock()
+        self.memory = MemoryManager(
+            model, tokenizer, config.memory, config.prompt.context_window_size,
+            model_lock=self._model_lock
+        )  # ✅ 使用真實 PostgreSQL 記憶管理器
         self.last_analysis = {}
+        # 靜態前綴（chat template 開頭 + 階段 system prompt）的 token 快取
+        self._prefix_ids_cache: Dict[str, torch.Tensor] = {}
+        # 靜態前綴 prefill 後的 KV cache，每輪只需 prefill 變動部分
+        self._prefix_kv_cache: Dict[str, DynamicCache] = {}
+        self._warm_prefix_cache()
 
     # -----------------------------------------------------
     # 🌐 主流程：對話回覆
     # -----------------------------------------------------
     def process(self, messages):
         """生成回覆、分析與記憶更新"""
-        # 1️⃣ 格式化對話內容
-        if self.config.prompt.use_socratic_template:
-            current_stage = self.memory.current_stage
-            formatted_messages = self.prompt_formatter.format_conversation(
-                messages, use_template=True, stage=current_stage
-            )
-        else:
-            formatted_messages = messages
+        return "".join(self.stream(messages))
 
-        # 2️⃣ 套用 chat template
-        text = self.tokenizer.apply_chat_template(
-            formatted_messages, tokenize=False, add_generation_prompt=True
-        )
-        #這邊的tokenizer，是autotokenizer，因此套用Qwen讀得懂的模板讓Qwen讀上下文。
+    def stream(self, messages):
+        """
+        逐段產生回覆（供 st.write_stream 使用），
+        生成完畢後才進行分析與記憶更新。
+        """
+        # UI 開始新對話時先重置記憶，避免沿用上一段對話的階段
+        self.memory.sync_conversation(messages)
+
+        # 1️⃣ 格式化對話內容 + 2️⃣ 套用 chat template
+        text, static_prompt = self._render_prompt(messages, self.memory.current_stage)
 
-        # 3️⃣ 模型生成
-        inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
+        # 3️⃣ 模型生成（背景執行緒生成，主執行緒逐段取出文字）
+        input_ids, prefix = self._encode_prompt(text, static_prompt)
+        cache_kwargs = self.config.generation.to_cache_kwargs()
         with torch.inference_mode():
-            #input真正轉成token+生成output
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=self.config.generation.max_new_tokens,
-                temperature=self.config.generation.temperature,
-                top_p=self.config.generation.top_p,
-                repetition_penalty=self.config.generation.repetition_penalty,
-            )
-        response = self.tokenizer.decode(
-            outputs[0][inputs.input_ids.shape[1]:],
-            skip_special_tokens=True
+            # 量化 KV cache 由 generate 自行建立，無法接續前綴的 DynamicCache
+            if prefix is not None and self.config.generation.reuse_prefix_cache and not cache_kwargs:
+                cache_kwargs["past_key_values"] = self._get_prefix_kv(prefix)
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
         )
+        errors = []
+        #input真正轉成token+生成output
+        thread = Thread(target=self._generate, args=(streamer, errors), kwargs=dict(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=self.config.generation.max_new_tokens,
+            temperature=self.config.generation.temperature,
+            top_p=self.config.generation.top_p,
+            repetition_penalty=self.config.generation.repetition_penalty,
+            **cache_kwargs,
+        ))
+        thread.start()
+        chunks = []
+        for chunk in streamer:
+            chunks.append(chunk)
+            yield chunk
+        thread.join()
+        if errors:
+            raise errors[0]
+        response = "".join(chunks)
 
         # 4️⃣ 解析分析結果
         self.last_analysis = self.extract_analysis(response)
 
         # 5️⃣ 更新資料庫記憶
         try:
-            # 將用戶與 AI 對話加入記憶
-            for msg in messages:
-                self.memory.add_message(msg["role"], msg["content"])
+            # 將新的用戶訊息與 AI 回覆加入記憶（已加入過的歷史不重播）
+            self.memory.add_new_messages(messages)
             self.memory.add_message("assistant", response)
             # 更新情緒、信念、階段等分析資訊
             self.memory.update_analysis(self.last_analysis)
-            # 若為結案階段，自動儲存 Session
+            # 若為結案階段，於背景儲存 Session（與回覆返回重疊）
             if self.memory.is_closure_stage(self.last_analysis):
-                self.memory.save_session()
+                self.memory.save_session_async()
         except Exception as e:
             print(f"[Memory Error] 無法更新資料庫記憶: {str(e)}")
 
-        # 6️⃣ 回傳 LLM 回覆
-        torch.cuda.empty_cache()
-        return response
+    def _generate(self, streamer: TextIteratorStreamer, errors: list, **generate_kwargs):
+        """在背景執行緒執行 generate；失敗時結束 streamer 並記錄錯誤，避免主執行緒卡住"""
+        try:
+            with self._model_lock, torch.inference_mode():
+                self.model.generate(streamer=streamer, **generate_kwargs)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+
+    # -----------------------------------------------------
+    # 🔤 Tokenize（靜態前綴快取）
+    # -----------------------------------------------------
+    def _render_prompt(self, messages, stage: str) -> Tuple[str, Optional[str]]:
+        """
+        格式化對話並套用 chat template。
+
+        Returns:
+            (完整 prompt 文字, 該階段的靜態 system prompt；未使用模板時為 None)
+        """
+        static_prompt = None
+        if self.config.prompt.use_socratic_template:
+            formatted_messages = self.prompt_formatter.format_conversation(
+                messages, use_template=True, stage=stage
+            )
+            static_prompt = self.prompt_formatter.template.get_system_prompt(stage)
+        else:
+            formatted_messages = messages
+
+        text = self.tokenizer.apply_chat_template(
+            formatted_messages, tokenize=False, add_generation_prompt=True
+        )
+        #這邊的tokenizer，是autotokenizer，因此套用Qwen讀得懂的模板讓Qwen讀上下文。
+        return text, static_prompt
+
+    def _warm_prefix_cache(self):
+        """啟動時先 tokenize 各階段的靜態前綴，對話中不再對它們做 BPE"""
+        if not self.config.prompt.use_socratic_template:
+            return
+        probe = [{"role": "user", "content": "你好"}]
+        for stage in STAGE_RULES:
+            self._encode_prompt(*self._render_prompt(probe, stage))
+
+    def _encode_prompt(
+        self, text: str, static_prompt: Optional[str] = None
+    ) -> Tuple[torch.Tensor, Optional[str]]:
+        """
+        將 chat template 文字轉為模型裝置上的 input_ids。
+        階段 system prompt 每輪都相同，只在第一次 tokenize 後快取（常駐模型裝置），
+        之後每輪只 tokenize 並傳輸後面變動的上下文與使用者輸入。
+
+        Returns:
+            (input_ids, 快取的前綴文字；無法切分時為 None)
+        """
+        split = text.find(static_prompt) if static_prompt else -1
+        if split >= 0:
+            # 切點延伸到整段換行之後，使前後兩段的 BPE 分詞與整段 tokenize 一致
+            split += len(static_prompt)
+            while split < len(text) and text[split] in "\r\n":
+                split += 1
+        if split < 0 or split >= len(text) or text[split].isspace():
+            return self._to_device(self.tokenizer([text], return_tensors="pt").input_ids), None
+
+        prefix = text[:split]
+        prefix_ids = self._prefix_ids_cache.get(prefix)
+        if prefix_ids is None:
+            prefix_ids = self.tokenizer([prefix], return_tensors="pt").input_ids
+            prefix_ids = prefix_ids.to(self.model.device)
+            self._prefix_ids_cache[prefix] = prefix_ids
+        suffix_ids = self.tokenizer(
+            [text[split:]], return_tensors="pt", add_special_tokens=False
+        ).input_ids
+        return torch.cat([prefix_ids, self._to_device(suffix_ids)], dim=1), prefix
+
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        """以 pinned memory 非同步傳到 GPU，不阻塞後續 kernel 的排程"""
+        if self.model.device.type == "cuda":
+            return tensor.pin_memory().to(self.model.device, non_blocking=True)
+        return tensor.to(self.model.device)
+
+    def _get_prefix_kv(self, prefix: str) -> DynamicCache:
+        """
+        取得靜態前綴的 KV cache 副本。
+        第一次遇到該前綴時 prefill 一次並快取；generate 會就地延伸 cache，
+        因此每輪回傳深拷貝，讓快取本身維持只含前綴。
+        前綴只由靜態模板決定，與 session 無關，重置對話時不需清除。
+        """
+        cache = self._prefix_kv_cache.get(prefix)
+        if cache is None:
+            with self._model_lock:
+                outputs = self.model(
+                    input_ids=self._prefix_ids_cache[prefix],
+                    past_key_values=DynamicCache(),
+                    use_cache=True,
+                )
+            cache = outputs.past_key_values
+            self._prefix_kv_cache[prefix] = cache
+        return copy.deepcopy(cache)
 
     # -----------------------------------------------------
     # 📊 分析模組（維持輕量）
@@ -117,13 +261,9 @@ class QwenAgent:
     def extract_analysis(self, response: str):
         """根據 LLM 回覆解析情緒、信念、階段"""
         analysis = {"emotion": "未知", "context": "未知", "belief": "未知", "stage": "未知"}
-        for key in analysis.keys():
-            token = f"【{key}】"
-            if token in response:
-                try:
-                    analysis[key] = response.split(token)[1].split("\n")[0].strip()
-                except:
-                    pass
+        # 反向建立 dict，同一欄位出現多次時以第一次為準
+        for key, value in dict(reversed(_ANALYSIS_RE.findall(response))).items():
+            analysis[key] = value.strip()
         return analysis
 
     def get_analysis(self):
@@ -144,7 +284,9 @@ class QwenAgent:
 class AgentFactory:
     """建立 Agent 實例"""
     @staticmethod
-    def create_agent(config: AppConfig) -> QwenAgent:
-        loader = ModelLoader(config)
-        model, tokenizer = loader.load()
+    def create_agent(config: AppConfig, model=None, tokenizer=None) -> QwenAgent:
+        """建立 Agent；若已有載入好的模型與 tokenizer 則直接沿用"""
+        if model is None or tokenizer is None:
+            loader = ModelLoader(config)
+            model, tokenizer = loader.load()
         return QwenAgent(model, tokenizer, config)
@@ -6,7 +6,7 @@ main_min.py
 
 import streamlit as st
 from config2 import AppConfig, get_default_config
-from llm_loader2 import AgentFactory, QwenAgent
+from llm_loader2 import AgentFactory, ModelLoader, QwenAgent
 
 
 # =========================================================
@@ -52,15 +52,15 @@ class StreamlitUI:
         #這個寫法不同於render_chat_hsitory，這邊是處理即時輸入，而只顯示單行訊息
         st.session_state.messages.append({"role": "user", "content": user_input})
 
-        # 呼叫 Agent
-        response = self.agent.process(st.session_state.messages)
-        #把st.session_state.messages傳入process，作為process的messages。
-        #process包含:轉換messages格式變成prompt排版/套用Qwen讀得懂的模板讓Qwen讀上下文(autotokenizer)/input真正轉成token+生成output/
+        # 呼叫 Agent，邊生成邊顯示回覆
+        response = st.chat_message("assistant").write_stream(
+            self.agent.stream(st.session_state.messages)
+        )
+        #把st.session_state.messages傳入stream，作為stream的messages。
+        #stream包含:轉換messages格式變成prompt排版/套用Qwen讀得懂的模板讓Qwen讀上下文(autotokenizer)/input真正轉成token+生成output/
         #解碼第一個output，並切除output中input原本的句長作為真正的response/紀錄response中，經過分析後key的value/暫時關閉紀錄梯度/
         #加入新對話到記憶/累加所有的情緒和信念/更新當下的階段/儲存id、摘要、最後階段、信念及情緒趨勢、總輪次
 
-        # 顯示回覆
-        st.chat_message("assistant").write(response)
         st.session_state.messages.append({"role": "assistant", "content": response})
 
     def run(self):
@@ -76,10 +76,21 @@ class StreamlitUI:
 # =========================================================
 # ⚙️ 快取載入 Agent（避免重複載入模型）
 # =========================================================
+def _model_cache_key(config: AppConfig) -> str:
+    """模型快取只依模型設定決定，修改 UI 等其他設定時不會重新載入模型"""
+    return repr(config.model)
+
+
+@st.cache_resource(hash_funcs={AppConfig: _model_cache_key})
+def load_model(config: AppConfig):
+    with st.spinner("🔄 載入模型中..."):
+        return ModelLoader(config).load()
+
+
 @st.cache_resource
 def load_agent(config: AppConfig) -> QwenAgent:
-    with st.spinner("🔄 載入模型中..."):
-        return AgentFactory.create_agent(config)
+    model, tokenizer = load_model(config)
+    return AgentFactory.create_agent(config, model, tokenizer)
 
 
 # =========================================================
@@ -1,15 +1,17 @@
 """
-記憶管理器 - 使用 LangChain 的 ConversationSummaryMemory
+記憶管理器 - 近期對話環形緩衝 + 結案時單次摘要
 """
 
+from collections import deque
 from typing import List, Dict, Optional, Tuple
 import logging
+import re
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
 from datetime import datetime
 
-from langchain.memory import ConversationSummaryMemory
-from langchain_community.llms import HuggingFacePipeline
-from transformers import pipeline
+import torch
 
 from config2 import MemoryConfig
 from database import DatabaseManager
@@ -17,11 +19,15 @@ from prompt_templates2_pro import QuestioningStage
 
 logger = logging.getLogger(__name__)
 
+# 所有階段名稱的單一正則，一次掃描即可找出分析文字中的階段
+_STAGE_RE = re.compile("|".join(re.escape(stage.value) for stage in QuestioningStage))
+
 
 class MemoryManager:
-    """記憶管理器 - 整合 LangChain 記憶系統與資料庫"""
+    """記憶管理器 - 整合對話緩衝、摘要與資料庫"""
     
-    def __init__(self, model, tokenizer, config: MemoryConfig):
+    def __init__(self, model, tokenizer, config: MemoryConfig, context_window_size: int = 3,
+                 model_lock: Optional[Lock] = None):
         """
         初始化記憶管理器
         
@@ -29,19 +35,30 @@ class MemoryManager:
             model: Transformers 模型
             tokenizer: Tokenizer
             config: 記憶系統配置
+            context_window_size: 保留的最近對話輪數
+            model_lock: 與對話代理共用的模型鎖，避免摘要與回覆同時生成
         """
         self.config = config
         self.model = model
         self.tokenizer = tokenizer
+        self._model_lock = model_lock or Lock()
         
-        # 初始化 LangChain 記憶系統
+        # 近期對話緩衝：(role, content)，每輪含用戶與助理兩則訊息
         if self.config.use_summary_memory:
-            self.memory = self._init_langchain_memory()
+            self.memory: Optional[deque] = deque(maxlen=2 * context_window_size)
         else:
             self.memory = None
+        # 結案時由 LLM 產生的摘要
+        self.summary_text = ""
+        # 本 session 加入緩衝區的訊息總數（緩衝區有長度上限，不能以其長度代替）
+        self._message_count = 0
+        # 已加入記憶的訊息數（對應 UI 訊息列表的位置），避免每輪重播整段歷史
+        self._seen = 0
         
-        # 初始化資料庫管理器
-        self.db_manager = DatabaseManager(config)
+        # 初始化資料庫管理器（記憶系統停用時不建立連線池）
+        self.db_manager = DatabaseManager(config) if self.config.use_summary_memory else None
+        # 單一背景執行緒負責 session 寫入，確保儲存順序
+        self._save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-save")
         
         # Session 管理
         self.current_session_id = str(uuid.uuid4())
@@ -52,36 +69,8 @@ class MemoryManager:
         # 記錄情緒和信念變化
         self.emotion_history: List[str] = []
         self.belief_history: List[str] = []
-    
-    def _init_langchain_memory(self) -> ConversationSummaryMemory:
-        """初始化 LangChain ConversationSummaryMemory"""
-        try:
-            # 創建 HuggingFace Pipeline for LangChain
-            text_gen_pipeline = pipeline(
-                "text-generation",
-                model=self.model,
-                tokenizer=self.tokenizer,
-                max_new_tokens=100,
-                temperature=0.7,
-                do_sample=True
-            )
-            
-            # 包裝為 LangChain LLM
-            llm = HuggingFacePipeline(pipeline=text_gen_pipeline)
-            
-            # 創建 ConversationSummaryMemory
-            memory = ConversationSummaryMemory(
-                llm=llm,
-                max_token_limit=self.config.max_token_limit,
-                return_messages=True
-            )
-            
-            logger.info("✅ LangChain 記憶系統初始化成功")
-            return memory
-            
-        except Exception as e:
-            logger.error(f"❌ LangChain 記憶系統初始化失敗: {e}")
-            return None
+        # 增量統計，趨勢查詢不需重新掃描歷史
+        self._reset_analysis_counters()
     
     def add_message(self, role: str, content: str):
         """
@@ -91,14 +80,14 @@ class MemoryManager:
             role: 角色 (user/assistant)
             content: 訊息內容
         """
-        if not self.memory:
+        self._seen += 1
+        if self.memory is None:
             return
         
         try:
-            if role == "user":
-                self.memory.chat_memory.add_user_message(content)
-            elif role == "assistant":
-                self.memory.chat_memory.add_ai_message(content)
+            if role in ("user", "assistant"):
+                self.memory.append((role, content))
+                self._message_count += 1
             
             self.conversation_turns += 1
             logger.debug(f"📝 訊息已加入記憶: {role}")
@@ -106,6 +95,28 @@ class MemoryManager:
         except Exception as e:
             logger.error(f"❌ 添加訊息失敗: {e}")
     
+    def add_new_messages(self, messages: List[Dict[str, str]]):
+        """
+        只將尚未加入的訊息添加到記憶系統
+        
+        Args:
+            messages: 完整的對話訊息列表（UI 端持續累積）
+        """
+        self.sync_conversation(messages)
+        for msg in messages[self._seen:]:
+            self.add_message(msg["role"], msg["content"])
+    
+    def sync_conversation(self, messages: List[Dict[str, str]]):
+        """
+        訊息列表比已加入的還短時，表示 UI 已開始新的對話
+        （重新整理頁面或開新分頁），重置 session 後從頭同步，避免新訊息被略過
+        
+        Args:
+            messages: 完整的對話訊息列表（UI 端持續累積）
+        """
+        if len(messages) < self._seen:
+            self.reset_session()
+    
     def get_summary(self) -> str:
         """
         獲取對話摘要
@@ -113,18 +124,16 @@ class MemoryManager:
         Returns:
             對話摘要文本
         """
-        if not self.memory:
+        if self.memory is None:
             return "記憶系統未啟用"
         
         try:
-            # 使用 LangChain 的 buffer 屬性獲取摘要
-            summary = self.memory.buffer
+            summary = self.summary_text
             
             if not summary:
                 # 如果沒有摘要，手動生成
-                messages = self.memory.chat_memory.messages
-                if messages:
-                    summary = f"對話共 {len(messages)} 輪，包含 {self.conversation_turns} 個回合。"
+                if self._message_count:
+                    summary = f"對話共 {self._message_count} 輪，包含 {self.conversation_turns} 個回合。"
             
             return summary
             
@@ -139,27 +148,69 @@ class MemoryManager:
         Returns:
             記憶上下文文本
         """
-        if not self.memory:
+        if self.memory is None:
             return ""
         
         try:
-            # 獲取最近的對話記錄
-            messages = self.memory.chat_memory.messages
-            if not messages:
-                return ""
-            
-            # 格式化為文本
-            context_lines = []
-            for msg in messages[-6:]:  # 最近3輪對話
-                role = "用戶" if msg.type == "human" else "助理"
-                context_lines.append(f"{role}: {msg.content}")
-            
-            return "\n".join(context_lines)
+            # 緩衝區只保留最近的對話，直接格式化為文本
+            return self._format_context(self.memory)
             
         except Exception as e:
             logger.error(f"❌ 獲取記憶上下文失敗: {e}")
             return ""
     
+    @staticmethod
+    def _format_context(history) -> str:
+        """將 (role, content) 序列格式化為對話文本"""
+        return "\n".join(
+            f"{'用戶' if role == 'user' else '助理'}: {content}"
+            for role, content in history
+        )
+    
+    def summarize_session(self) -> str:
+        """
+        以 LLM 對緩衝區中的對話做一次摘要（僅在同步結案儲存時呼叫）
+        
+        Returns:
+            對話摘要文本
+        """
+        if self.memory:
+            summary = self._generate_summary(self._format_context(self.memory))
+            if summary is not None:
+                self.summary_text = summary
+        return self.get_summary()
+    
+    def _generate_summary(self, context: str) -> Optional[str]:
+        """
+        以 LLM 摘要對話文本
+        
+        Returns:
+            摘要文本；生成失敗時為 None
+        """
+        try:
+            messages = [{
+                "role": "user",
+                "content": f"請用兩到三句話摘要以下諮商對話的重點，包含情緒與想法的變化：\n{context}"
+            }]
+            text = self.tokenizer.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
+            with self._model_lock, torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=self.config.summary_max_new_tokens,
+                    do_sample=False
+                )
+            return self.tokenizer.decode(
+                outputs[0][inputs.input_ids.shape[1]:],
+                skip_special_tokens=True
+            ).strip()
+            
+        except Exception as e:
+            logger.error(f"❌ 生成摘要失敗: {e}")
+            return None
+    
     def update_analysis(self, analysis: Dict):
         """
         更新分析資訊
@@ -169,20 +220,29 @@ class MemoryManager:
         """
         # 更新情緒歷史
         if "emotion" in analysis:
-            self.emotion_history.append(analysis["emotion"])
+            emotion = analysis["emotion"]
+            self.emotion_history.append(emotion)
+            if "正向" in emotion:
+                self._emotion_counts["正向"] += 1
+            if "負向" in emotion:
+                self._emotion_counts["負向"] += 1
+            if "正向" not in emotion and "負向" not in emotion:
+                self._emotion_counts["中性"] += 1
         
         # 更新信念歷史
         if "belief" in analysis:
-            self.belief_history.append(analysis["belief"])
+            belief = analysis["belief"]
+            self.belief_history.append(belief)
+            for belief_type in self._belief_flags:
+                if belief_type in belief:
+                    self._belief_flags[belief_type] = True
         
         # 更新當前階段
         if "stage" in analysis:
-            stage_text = analysis["stage"]
             # 提取階段名稱（可能包含其他文字）
-            for stage in QuestioningStage:
-                if stage.value in stage_text:
-                    self.current_stage = stage.value
-                    break
+            match = _STAGE_RE.search(analysis["stage"])
+            if match:
+                self.current_stage = match.group(0)
     
     def is_closure_stage(self, analysis: Dict) -> bool:
         """
@@ -206,29 +266,68 @@ class MemoryManager:
         Returns:
             是否儲存成功
         """
+        if not self.config.use_summary_memory:
+            return False
+        
         try:
-            # 獲取摘要
-            summary = self.get_summary()
-            
-            # 分析情緒趨勢
-            emotion_trend = self._analyze_emotion_trend()
+            self.summarize_session()
+            return self._write_session(self._collect_session_record())
             
-            # 分析信念變化
-            belief_change = self._analyze_belief_change()
-            
-            # 儲存到資料庫
-            success = self.db_manager.save_session_summary(
-                user_id=self.current_user_id,
-                session_id=self.current_session_id,
-                summary_text=summary,
-                stage_completed=self.current_stage,
-                emotion_trend=emotion_trend,
-                belief_change=belief_change,
-                total_turns=self.conversation_turns
-            )
+        except Exception as e:
+            logger.error(f"❌ 儲存 Session 失敗: {e}")
+            return False
+    
+    def save_session_async(self) -> Future:
+        """
+        在背景執行緒摘要並儲存當前 session，不阻塞回覆的串流輸出
+        
+        呼叫端只複製緩衝區與統計結果（不呼叫模型）；LLM 摘要與資料庫寫入
+        都在背景執行緒以快照進行，不會與後續對話的狀態更新互相競爭。
+        
+        Returns:
+            完成時結果為是否儲存成功的 Future
+        """
+        record = None
+        if self.config.use_summary_memory:
+            try:
+                record = self._collect_session_record()
+                history = list(self.memory)
+            except Exception as e:
+                logger.error(f"❌ 儲存 Session 失敗: {e}")
+        
+        if record is None:
+            future = Future()
+            future.set_result(False)
+            return future
+        return self._save_executor.submit(self._summarize_and_write, record, history)
+    
+    def _summarize_and_write(self, record: Dict, history: List[Tuple[str, str]]) -> bool:
+        """背景執行緒：以對話快照生成摘要後寫入資料庫（摘要失敗時沿用快照中的摘要）"""
+        if history:
+            summary = self._generate_summary(self._format_context(history))
+            if summary is not None:
+                record["summary_text"] = summary
+        return self._write_session(record)
+    
+    def _collect_session_record(self) -> Dict:
+        """擷取要寫入資料庫的 session 資料（只讀取現有狀態，不呼叫模型）"""
+        return {
+            "user_id": self.current_user_id,
+            "session_id": self.current_session_id,
+            "summary_text": self.get_summary(),
+            "stage_completed": self.current_stage,
+            "emotion_trend": self._analyze_emotion_trend(),
+            "belief_change": self._analyze_belief_change(),
+            "total_turns": self.conversation_turns
+        }
+    
+    def _write_session(self, record: Dict) -> bool:
+        """將 session 資料寫入資料庫"""
+        try:
+            success = self.db_manager.save_session_summary(**record)
             
             if success:
-                logger.info(f"✅ Session 已儲存: {self.current_session_id}")
+                logger.info(f"✅ Session 已儲存: {record['session_id']}")
             
             return success
             
@@ -241,21 +340,18 @@ class MemoryManager:
         if not self.emotion_history:
             return "無情緒記錄"
         
-        # 簡單分析：計算正向、中性、負向數量
-        positive_count = sum(1 for e in self.emotion_history if "正向" in e)
-        negative_count = sum(1 for e in self.emotion_history if "負向" in e)
-        neutral_count = len(self.emotion_history) - positive_count - negative_count
-        
-        return f"正向:{positive_count} 中性:{neutral_count} 負向:{negative_count}"
+        # 簡單分析：正向、中性、負向數量（於 update_analysis 累計）
+        counts = self._emotion_counts
+        return f"正向:{counts['正向']} 中性:{counts['中性']} 負向:{counts['負向']}"
     
     def _analyze_belief_change(self) -> str:
         """分析信念變化"""
         if not self.belief_history:
             return "無信念記錄"
         
-        # 簡單分析：從非理性到理性的變化
-        has_irrational = any("非理性" in b for b in self.belief_history)
-        has_rational = any("理性" in b for b in self.belief_history)
+        # 簡單分析：從非理性到理性的變化（於 update_analysis 記錄）
+        has_irrational = self._belief_flags["非理性"]
+        has_rational = self._belief_flags["理性"]
         
         if has_irrational and has_rational:
             return "從非理性轉為理性"
@@ -266,6 +362,11 @@ class MemoryManager:
         else:
             return "未識別信念類型"
     
+    def _reset_analysis_counters(self):
+        """重置情緒與信念的增量統計"""
+        self._emotion_counts = {"正向": 0, "中性": 0, "負向": 0}
+        self._belief_flags = {"理性": False, "非理性": False}
+    
     def reset_session(self):
         """重置 session（結案後開始新一輪）"""
         logger.info(f"🔄 重置 Session: {self.current_session_id}")
@@ -275,6 +376,8 @@ class MemoryManager:
         
         # 重置計數器
         self.conversation_turns = 0
+        self._seen = 0
+        self._message_count = 0
         
         # 重置階段
         self.current_stage = QuestioningStage.CLARIFY.value
@@ -282,9 +385,11 @@ class MemoryManager:
         # 清空歷史
         self.emotion_history = []
         self.belief_history = []
+        self._reset_analysis_counters()
+        self.summary_text = ""
         
         # 清空記憶（如果需要）
-        if self.memory:
+        if self.memory is not None:
             self.memory.clear()
     
     def get_session_info(self) -> Dict:
@@ -311,6 +416,8 @@ class MemoryManager:
     
     def close(self):
         """關閉資料庫連線"""
+        # 等待尚未完成的背景寫入
+        self._save_executor.shutdown(wait=True)
         if self.db_manager:
             self.db_manager.close()
 
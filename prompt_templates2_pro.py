@@ -3,10 +3,11 @@ Prompt Template 管理 - 多層控制版（Socratic Counseling Pro）
 支援：動態階段模板、語氣限制、自動階段檢查
 """
 
-from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Optional
 from enum import Enum
+from types import MappingProxyType
 import re
+import sys
 
 
 # ==========================================================
@@ -44,7 +45,7 @@ class BeliefType(Enum):
 # ==========================================================
 # 多層控制結構：階段規則庫
 # ==========================================================
-STAGE_RULES = {
+_RAW_STAGE_RULES = {
     "澄清問題": {
         "goal": "根據來談者輸入，寒暄或是引導來談者說出情緒、情境，及造成這些情緒、情境的想法。",
         "allowed_tone": ["中性", "探索"],
@@ -105,20 +106,120 @@ STAGE_RULES = {
     }
 }
 
+# 階段名稱 intern 後，以 intern 過的 stage 查表時可直接以指標比對命中；
+# 規則為唯讀常數，凍結成 MappingProxyType，清單欄位改為 tuple
+STAGE_RULES = MappingProxyType({
+    sys.intern(stage): MappingProxyType({
+        key: tuple(value) if isinstance(value, list) else value
+        for key, value in rules.items()
+    })
+    for stage, rules in _RAW_STAGE_RULES.items()
+})
+# 合法的階段名稱；只在對外入口檢查一次，內部一律直接索引
+_VALID_STAGES = frozenset(STAGE_RULES)
+
+
+def _check_stage(stage: str) -> str:
+    """驗證並 intern 階段名稱，未知階段拋出 ValueError"""
+    if stage not in _VALID_STAGES:
+        raise ValueError(f"未知的諮商階段：{stage}")
+    return sys.intern(stage)
+
+
+# 對話角色常數（intern，與訊息中的角色字串比對時走指標相等的捷徑）
+_USER = sys.intern("user")
+# 上下文中各角色的行首標示；非 user 的角色一律視為助理
+_ROLE_PREFIX = {_USER: "用戶: "}
+_OTHER_ROLE_PREFIX = "助理: "
+
+# 預先將各階段的清單欄位串成字串，組 prompt 時不必每次 join
+_STAGE_RULES_FMT = {
+    stage: {
+        "goal": rules["goal"],
+        "allowed_tone": ", ".join(rules["allowed_tone"]),
+        "forbidden_patterns": ", ".join(rules["forbidden_patterns"]),
+        "question_type": ", ".join(rules["question_type"]),
+    }
+    for stage, rules in STAGE_RULES.items()
+}
+
+# 階段提示模板與各階段的填入值（format_map 直接取用，呼叫時不需另建 dict）
+_STAGE_TEMPLATE = """
+【目前階段】：{stage}
+【階段目標】：{goal}
+【允許語氣】：{allowed_tone}
+【禁止語氣】：{forbidden_patterns}
+【提問類型】：{question_type}
+
+請根據此階段目標，生成一個開放式提問，以「?」結尾。
+"""
+_STAGE_CTX = {stage: {"stage": stage, **fmt} for stage, fmt in _STAGE_RULES_FMT.items()}
+# 階段與規則皆為靜態，匯入時即產生各階段完整的階段提示
+_STAGE_PROMPT_BY_STAGE = {stage: _STAGE_TEMPLATE.format_map(ctx) for stage, ctx in _STAGE_CTX.items()}
+
+# 各階段禁止語氣合併為單一正則，檢查生成內容時只需掃描一次
+_STAGE_FORBIDDEN_RE = {
+    stage: re.compile("|".join(re.escape(p) for p in rules["forbidden_patterns"]))
+    for stage, rules in STAGE_RULES.items()
+    if rules["forbidden_patterns"]
+}
+
+
+def _build_forbidden_stages() -> Dict[str, frozenset]:
+    """
+    建立所有階段的禁止語氣 → 命中時違反的階段集合。
+    較長的片段也算入其前綴片段所屬的階段，因同一起點只會取最長的那個。
+    """
+    stages_by_pattern: Dict[str, frozenset] = {}
+    for stage, rules in STAGE_RULES.items():
+        for pattern in rules["forbidden_patterns"]:
+            stages_by_pattern[pattern] = stages_by_pattern.get(pattern, frozenset()) | {stage}
+    return {
+        p: frozenset().union(*(stages for q, stages in stages_by_pattern.items() if p.startswith(q)))
+        for p in stages_by_pattern
+    }
+
+
+_FORBIDDEN_STAGES = _build_forbidden_stages()
+# 以 lookahead 在每個位置比對（可重疊），一次掃描即找出所有階段的禁止語氣；
+# 沒有任何禁止語氣時使用永不命中的 (?!)
+_FORBIDDEN_ALL_RE = re.compile(
+    "(?=(" + "|".join(re.escape(p) for p in sorted(_FORBIDDEN_STAGES, key=len, reverse=True)) + "))"
+    if _FORBIDDEN_STAGES else "(?!)"
+)
+
+
+def forbidden_stages(text: str) -> frozenset:
+    """回傳 text 違反禁止語氣的所有階段（單次掃描）"""
+    hits = {m.group(1) for m in _FORBIDDEN_ALL_RE.finditer(text)}
+    return frozenset().union(*(_FORBIDDEN_STAGES[p] for p in hits))
+
+
+# 分析提示中上下文與使用者輸入的標題（含前後換行）
+_CONTEXT_HEADER = "\n\n【對話上下文】\n"
+_INPUT_HEADER = "\n\n【使用者輸入】\n"
+
+# 注入 prompt 的最近對話訊息數（3 輪）
+CONTEXT_MESSAGES = 6
+
+# 沒有任何訊息時回傳的共用結果（呼叫端視為唯讀，不會修改）
+_EMPTY_SYSTEM_MSG = [{"role": "system", "content": ""}]
+
 # ==========================================================
 # Prompt Template 主體
 # ==========================================================
-@dataclass
 class PromptTemplate:
-    """Prompt 模板配置（升級版）"""
-    
-    system_role: str = (
+    """Prompt 模板配置（升級版）；內容皆為類別常數，實例不帶任何狀態"""
+
+    __slots__ = ()
+
+    system_role = (
         "你是一位嚴肅認真的心理諮商助理，採用蘇格拉底式提問法，"
         "目的在於幫助來談者覺察核心信念及其造成的因果關係。"
     )
 
     # 全域規則說明
-    base_rules: str = """【通用規則】
+    base_rules = """【通用規則】
 - 來談者打招呼時，進行簡單寒暄。
 - 不提供建議、安慰或結論。
 - 整體語氣保持自然、平和。
@@ -129,36 +230,30 @@ class PromptTemplate:
 - 詢問目前的諮商階段時，跳脫通用規則，僅回覆「目前是諮商階段：{stage}」。
 """
 
-    def get_stage_prompt(self, stage: str) -> str:
-        """生成階段專屬提示"""
-        rules = STAGE_RULES.get(stage, {})
-        return f"""
-【目前階段】：{stage}
-【階段目標】：{rules.get('goal')}
-【允許語氣】：{', '.join(rules.get('allowed_tone', []))}
-【禁止語氣】：{', '.join(rules.get('forbidden_patterns', []))}
-【提問類型】：{', '.join(rules.get('question_type', []))}
+    # 與階段無關的靜態前綴（角色 + 通用規則），只組一次
+    _prefix = f"{system_role}\n\n{base_rules}\n"
 
-請根據此階段目標，生成一個開放式提問，以「?」結尾。
-"""
+    def get_stage_prompt(self, stage: str) -> str:
+        """生成階段專屬提示（stage 須為合法階段）"""
+        return _STAGE_PROMPT_BY_STAGE[stage]
 
     def get_system_prompt(self, stage: str) -> str:
-        """整合全域與階段提示"""
-        stage_prompt = self.get_stage_prompt(stage)
-        return f"""{self.system_role}
-
-{self.base_rules}
-{stage_prompt}
-"""
+        """整合全域與階段提示（各階段於匯入時預先產生）"""
+        return _SYSTEM_PROMPT_BY_STAGE[stage]
 
     def get_analysis_prompt(self, user_input: str, stage: str, context: str = "") -> str:
-        """生成帶階段分析的提示"""
-        ctx = f"\n【對話上下文】\n{context}\n" if context else ""
-        return f"""{self.get_system_prompt(stage)}
-{ctx}
-【使用者輸入】
-{user_input}
-"""
+        """生成帶階段分析的提示（固定片段數，join 一次算出總長並只配置一次）"""
+        system_prompt = self.get_system_prompt(stage)
+        if context:
+            return "".join((system_prompt, _CONTEXT_HEADER, context, _INPUT_HEADER, user_input, "\n"))
+        return "".join((system_prompt, _INPUT_HEADER, user_input, "\n"))
+
+
+# 各階段完整 system prompt（模板內容皆為常數，匯入時一次產生）
+_SYSTEM_PROMPT_BY_STAGE = {
+    stage: "".join([PromptTemplate._prefix, stage_prompt, "\n"])
+    for stage, stage_prompt in _STAGE_PROMPT_BY_STAGE.items()
+}
 
 
 # ==========================================================
@@ -168,38 +263,60 @@ class PromptFormatter:
     """Prompt 格式化與階段控制"""
     
     def __init__(self, template: PromptTemplate = None):
-        self.template = template or PromptTemplate()
-
-    def _build_context(self, history: List[Dict[str, str]]) -> str:
-        """重組最近對話上下文"""
-        if not history:
-            return ""
-        context_lines = []
-        for msg in history[-6:]:
-            role = "用戶" if msg["role"] == "user" else "助理"
-            context_lines.append(f"{role}: {msg['content']}")
-        return "\n".join(context_lines)
+        # formatter 隨快取的 agent 由所有 session 共用，不保存任何對話狀態
+        self.template = template or _default_template()
+
+    def _build_context(self, messages, end: int) -> str:
+        """
+        重組 messages[:end] 中最近 CONTEXT_MESSAGES 則的對話上下文（直接索引，不切片複製）。
+        messages 為呼叫端的 dict 訊息列表；先轉成角色／內容陣列同樣需要逐則查 dict，因此直接讀取。
+        """
+        return "\n".join(
+            _ROLE_PREFIX.get(messages[i]["role"], _OTHER_ROLE_PREFIX) + messages[i]["content"]
+            for i in range(max(0, end - CONTEXT_MESSAGES), end)
+        )
 
     def format_with_stage(self, user_input: str, stage: str, conversation_history=None) -> str:
-        """整合上下文與階段生成完整提示"""
-        context = self._build_context(conversation_history)
+        """
+        整合上下文與階段生成完整提示。
+        未傳入 conversation_history 時不帶上下文；未知階段拋出 ValueError。
+        """
+        stage = _check_stage(stage)
+        if conversation_history is None:
+            context = ""
+        else:
+            context = self._build_context(conversation_history, len(conversation_history))
         return self.template.get_analysis_prompt(user_input, stage, context)
 
 
+    def violates_forbidden(self, text: str, stage: str) -> bool:
+        """檢查生成內容是否含有該階段的禁止語氣；未知階段拋出 ValueError"""
+        pattern = _STAGE_FORBIDDEN_RE.get(_check_stage(stage))
+        return bool(pattern and pattern.search(text))
+
+    def filter_forbidden(self, candidates: List[str], stage: str) -> List[str]:
+        """批次檢查多個候選回覆（如 best-of-N），只保留未違反該階段禁止語氣者；未知階段拋出 ValueError"""
+        stage = _check_stage(stage)
+        return [text for text in candidates if stage not in forbidden_stages(text)]
+
+
     # === 向下相容接口 ===
     def format_conversation(self, messages: List[Dict[str, str]], use_template: bool = True, stage: str = None) -> List[Dict[str, str]]:
         """
         與舊版相容：模擬舊有格式化邏輯。
-        預設使用澄清問題階段。
+        預設使用澄清問題階段；沒有任何訊息時回傳空白 system 訊息；未知階段拋出 ValueError。
         """
-        user_input = messages[-1]["content"] if messages else ""
-        conversation_history = messages[:-1] if len(messages) > 1 else []
-        current_stage = stage or "澄清問題"
-        if use_template:
-            system_prompt = self.format_with_stage(user_input, current_stage, conversation_history)
-        else:
-            # 若不使用模板，只回傳一般格式
-            system_prompt = f"使用者輸入：{user_input}"
+        if not messages:
+            return _EMPTY_SYSTEM_MSG
+        user_input = messages[-1]["content"]
+        if not use_template:
+            # 若不使用模板，只回傳一般格式（不需處理歷史）
+            return [{"role": "system", "content": f"使用者輸入：{user_input}"}]
+
+        # 上下文只取最後一則之前的最近幾則訊息，直接以索引讀取，不複製歷史
+        current_stage = _check_stage(stage or "澄清問題")
+        context = self._build_context(messages, len(messages) - 1)
+        system_prompt = self.template.get_analysis_prompt(user_input, current_stage, context)
 
         return [{
             "role": "system",
@@ -207,11 +324,42 @@ class PromptFormatter:
         }]
 
 
+# ==========================================================
+# 批次組裝（資料集生成、評估等大量呼叫）
+# ==========================================================
+def build_prompt_batch(user_inputs: List[str], stage: str, histories: List[str]) -> List[str]:
+    """
+    批次產生分析提示，輸出與逐筆呼叫 get_analysis_prompt 相同。
+    histories 為各筆已組好的上下文字串（可為空字串）；system prompt 只查一次。
+    """
+    if len(user_inputs) != len(histories):
+        raise ValueError("user_inputs 與 histories 長度不一致")
+    system_prompt = _default_template().get_system_prompt(_check_stage(stage))
+    with_ctx = system_prompt + _CONTEXT_HEADER
+    no_ctx = system_prompt + _INPUT_HEADER
+    return [
+        "".join((with_ctx, ctx, _INPUT_HEADER, user_input, "\n")) if ctx
+        else "".join((no_ctx, user_input, "\n"))
+        for user_input, ctx in zip(user_inputs, histories)
+    ]
+
+
 # ==========================================================
 # 工廠方法
 # ==========================================================
+_DEFAULT_TEMPLATE: Optional[PromptTemplate] = None
+
+
+def _default_template() -> PromptTemplate:
+    """共用的預設模板（第一次使用時建立）；模板不帶狀態，prompt 皆為模組層級常數"""
+    global _DEFAULT_TEMPLATE
+    if _DEFAULT_TEMPLATE is None:
+        _DEFAULT_TEMPLATE = PromptTemplate()
+    return _DEFAULT_TEMPLATE
+
+
 def create_default_template() -> PromptTemplate:
-    return PromptTemplate()
+    return _default_template()
 
 
 def create_formatter(template: PromptTemplate = None) -> PromptFormatter: